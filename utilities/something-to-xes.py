@@ -31,16 +31,29 @@
 import os
 import csv
 import sys
+import re
 from copy import copy as shallow_copy
 import gzip
+import zlib
+import json
+import Queue
+import threading
 from lxml import etree
 from lxml.etree import XPath
 from lxml.cssselect import CSSSelector
 from uuid import UUID
+from xml.sax.saxutils import escape
 import random
 import argparse
+import sqlite3
+import hashlib
+import struct
+import math
+import calendar
+import datetime
+from array import array
 import dateutil.parser
-from collections import defaultdict
+from collections import defaultdict, Counter, OrderedDict
 
 prog_name = os.path.basename(sys.argv[0])
 
@@ -141,6 +154,81 @@ def xml_handler(f, selector):
         result[child.tag + "." + name] = value
     yield result
 
+xes_attribute_tags = set(["string", "date", "int", "float", "boolean", "id"])
+
+def xes_attributes(el):
+  # Yields the (key, value, type) triples of the attributes directly below el
+  for child in el:
+    if not isinstance(child.tag, basestring):
+      continue
+    tag = etree.QName(child).localname
+    key = child.get("key")
+    if not tag in xes_attribute_tags or key is None:
+      continue
+    yield key, child.get("value"), tag
+
+def xes_handler(f, source, types):
+  # Streams the events out of an existing XES document. Each event's
+  # attributes appear under their XES keys, with their values in XES's textual
+  # representation; the attributes of the enclosing trace appear under
+  # "trace." followed by their keys, and "trace#" identifies that trace
+  # uniquely across all input files (as source, a dot, and the index of the
+  # trace in the document). As trace attributes may follow a trace's events,
+  # the events of each trace are held back until its end, so memory use grows
+  # with the size of the largest trace. (Nested attributes and log-level
+  # attributes are ignored.)
+  #
+  # The type of each attribute is recorded in types, so that mapping an
+  # attribute back to the same key can keep its type without an explicit
+  # --type; a key that turns up with more than one type is recorded as a
+  # string from then on
+  def learn(key, tag):
+    name = raw_name_to_name(key)
+    known = types.get(name)
+    if known is None:
+      types[name] = tag
+    elif known != tag and known != "string":
+      warn("the XES attribute \"%s\" has both the types %s and %s; " \
+          "treating it as a string" % (key, known, tag))
+      types[name] = "string"
+
+  trace_index = -1
+  pending = None
+  for action, el in etree.iterparse(f, events=("start", "end")):
+    if not isinstance(el.tag, basestring):
+      continue
+    tag = etree.QName(el).localname
+    if action == "start":
+      if tag == "trace":
+        trace_index += 1
+        pending = []
+      continue
+    if tag == "event":
+      result = {}
+      for key, value, attribute_type in xes_attributes(el):
+        learn(key, attribute_type)
+        result[key] = value
+      if pending is None:
+        yield result
+      else:
+        pending.append(result)
+    elif tag == "trace":
+      trace_attributes = {"trace#": "%s.%d" % (source, trace_index)}
+      for key, value, attribute_type in xes_attributes(el):
+        learn(key, attribute_type)
+        trace_attributes["trace." + key] = value
+      for result in pending:
+        result.update(trace_attributes)
+        yield result
+      pending = None
+    else:
+      continue
+    # Throw away every event and trace that's been dealt with, so that memory
+    # use doesn't grow with the size of the document. (A trace's own
+    # attributes stay put until the end of the trace.)
+    el.clear()
+    el.getparent().remove(el)
+
 def csv_handler(f, encoding, **fmtparams):
   def tidy(s):
     return unicode(s, encoding, errors='strict') if s else None
@@ -149,6 +237,251 @@ def csv_handler(f, encoding, **fmtparams):
   for row in reader:
     yield {a: b for a, b in zip(names, map(tidy, row)) if b}
 
+def event_fingerprint(e, keys=None):
+  # Events are fingerprinted by a digest of a canonical serialisation of their
+  # attributes (or of just the named ones), so that the set of events already
+  # seen doesn't have to keep the events themselves alive. Every key and value
+  # is preceded by its length, so that no two different events can produce the
+  # same serialisation. When only some keys are compared, a missing key hashes
+  # differently from any value, and events that have none of the keys can't be
+  # compared at all (None is returned). By default, the "trace#" attribute
+  # added by xes_handler is left out, as it only says where in the input an
+  # event was found
+  if keys is None:
+    keys = sorted(k for k in e.keys() if k != "trace#")
+  elif not any(e.get(k) is not None for k in keys):
+    return None
+  h = hashlib.sha1()
+  for k in keys:
+    v = e.get(k)
+    k = k.encode("utf-8") if isinstance(k, unicode) else k
+    h.update(struct.pack("<I", len(k)))
+    h.update(k)
+    if v is None:
+      h.update("\xff\xff\xff\xff")
+      continue
+    v = v.encode("utf-8") if isinstance(v, unicode) else v
+    h.update(struct.pack("<I", len(v)))
+    h.update(v)
+  return h.digest()[:16]
+
+class FingerprintSet(object):
+  def __init__(self):
+    self.seen = set()
+
+  def add(self, fp):
+    if fp in self.seen:
+      return False
+    self.seen.add(fp)
+    return True
+
+  def close(self):
+    pass
+
+class BloomFingerprintSet(FingerprintSet):
+  # A Bloom filter never forgets an event, but it can mistake a new one for a
+  # duplicate with probability roughly equal to error_rate (provided that no
+  # more than capacity events are added). Each event sets about
+  # log2(1 / error_rate) bits, one Python-level step at a time, so stricter
+  # error rates are noticeably slower
+  def __init__(self, capacity, error_rate):
+    assert capacity > 0 and 0 < error_rate < 1, \
+        "invalid Bloom filter parameters"
+    bits = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+    self.size = max(bits, 8)
+    self.hashes = max(int(round(float(self.size) / capacity * math.log(2))), 1)
+    self.bits = bytearray((self.size + 7) // 8)
+
+  def add(self, fp):
+    h1, h2 = struct.unpack("<QQ", fp)
+    size, bits = self.size, self.bits
+    new = False
+    for i in xrange(self.hashes):
+      bit = (h1 + i * h2) % size
+      byte, mask = bit >> 3, 1 << (bit & 7)
+      if not bits[byte] & mask:
+        bits[byte] |= mask
+        new = True
+    return new
+
+class DiskFingerprintSet(FingerprintSet):
+  # Fingerprints are kept in an SQLite database, whose index lives on disk
+  # rather than in memory. The database is deleted when closed unless keep is
+  # set
+  def __init__(self, path, keep=False):
+    self.path = path
+    self.keep = keep
+    if os.path.exists(path):
+      os.remove(path)
+    self.db = sqlite3.connect(path)
+    self.db.execute("PRAGMA journal_mode = OFF")
+    self.db.execute("PRAGMA synchronous = OFF")
+    self.db.execute("""\
+CREATE TABLE fingerprints (fp BLOB PRIMARY KEY) WITHOUT ROWID""")
+    self.pending = 0
+
+  def add(self, fp):
+    cursor = self.db.execute(
+        "INSERT OR IGNORE INTO fingerprints VALUES (?)", (sqlite3.Binary(fp),))
+    self.pending += 1
+    if self.pending >= 10000:
+      self.db.commit()
+      self.pending = 0
+    return cursor.rowcount == 1
+
+  def close(self):
+    self.db.commit()
+    self.db.close()
+    if not self.keep:
+      os.remove(self.path)
+
+def first_mapped_value(d, values):
+  for value in values:
+    try:
+      return value % d
+    except KeyError:
+      pass
+    except ValueError:
+      pass
+  return None
+
+iso_timestamp = re.compile(
+    r"^(\d{4})-(\d\d)-(\d\d)(?:[T ](\d\d):(\d\d)(?::(\d\d)(?:\.(\d{1,6}))?)?)?$")
+
+def parse_timestamp(v):
+  # dateutil.parser is very flexible and very slow; the most common format
+  # can be handled much more cheaply
+  m = iso_timestamp.match(v)
+  if m:
+    year, month, day, hour, minute, second, fraction = m.groups()
+    try:
+      return datetime.datetime(int(year), int(month), int(day),
+          int(hour or 0), int(minute or 0), int(second or 0),
+          int((fraction or "0").ljust(6, "0")))
+    except ValueError:
+      pass
+  return dateutil.parser.parse(v)
+
+def epoch_seconds(ts):
+  if ts.utcoffset() is not None:
+    ts = ts.replace(tzinfo=None) - ts.utcoffset()
+  return calendar.timegm(ts.timetuple()) + ts.microsecond / 1000000.0
+
+def distribution(counts):
+  # Summarises a {value: frequency} histogram
+  total = sum(counts.values())
+  if not total:
+    return None
+  values = sorted(counts)
+  def percentile(p):
+    threshold = p * total
+    seen = 0
+    for v in values:
+      seen += counts[v]
+      if seen >= threshold:
+        return v
+  return {
+    "min": values[0],
+    "max": values[-1],
+    "mean": sum(v * c for v, c in counts.items()) / float(total),
+    "median": percentile(0.5),
+    "p90": percentile(0.9),
+    "p99": percentile(0.99)
+  }
+
+class LogStatistics(object):
+  # Computes summary statistics in a single pass without keeping any events.
+  # As input events needn't be grouped by trace, every trace's state lives
+  # until the end, but that state is just a few numbers. Activity sequences
+  # are interned in a prefix tree shared by all traces, and each trace only
+  # records the node for its sequence so far. Memory use is therefore
+  # proportional to the number of traces plus the number of distinct
+  # sequence prefixes; the latter is usually far smaller than the number of
+  # events, but can approach it if almost every trace is unique
+  def __init__(self, activity_values, timestamp_values, top_variants=10):
+    self.activity_values = activity_values
+    self.timestamp_values = timestamp_values
+    self.top_variants = top_variants
+    self.events = 0
+    self.activities = Counter()
+    self.activity_ids = {}
+    self.activity_names = []
+    # The prefix tree: node 0 is the empty sequence, and every other node is
+    # its parent's sequence followed by one more activity
+    self.children = {}
+    self.parents = array("l", [-1])
+    self.labels = array("l", [-1])
+    # trace key -> [event count, first timestamp, last timestamp, node]
+    self.traces = {}
+
+  def add(self, trace, e):
+    self.events += 1
+    state = self.traces.get(trace)
+    if state is None:
+      state = self.traces[trace] = [0, None, None, 0]
+    state[0] += 1
+
+    activity = first_mapped_value(e, self.activity_values)
+    if activity is not None:
+      self.activities[activity] += 1
+      aid = self.activity_ids.get(activity)
+      if aid is None:
+        aid = self.activity_ids[activity] = len(self.activity_names)
+        self.activity_names.append(activity)
+      edge = (state[3], aid)
+      node = self.children.get(edge)
+      if node is None:
+        node = self.children[edge] = len(self.parents)
+        self.parents.append(state[3])
+        self.labels.append(aid)
+      state[3] = node
+
+    ts = first_mapped_value(e, self.timestamp_values)
+    if ts is not None:
+      try:
+        ts = epoch_seconds(parse_timestamp(ts))
+      except (ValueError, OverflowError):
+        return
+      if state[1] is None or ts < state[1]:
+        state[1] = ts
+      if state[2] is None or ts > state[2]:
+        state[2] = ts
+
+  def sequence(self, node):
+    activities = []
+    while node > 0:
+      activities.append(self.activity_names[self.labels[node]])
+      node = self.parents[node]
+    activities.reverse()
+    return activities
+
+  def summary(self):
+    lengths = Counter()
+    spans = Counter()
+    variants = Counter()
+    for count, first, last, node in self.traces.itervalues():
+      lengths[count] += 1
+      if first is not None:
+        spans[last - first] += 1
+      variants[node] += 1
+    return {
+      "events": self.events,
+      "traces": len(self.traces),
+      "events_per_trace": distribution(lengths),
+      "trace_span_seconds": distribution(spans),
+      "activities": {
+        "distinct": len(self.activities),
+        "frequencies": dict(self.activities)
+      },
+      "variants": {
+        "distinct": len(variants),
+        "top": [{
+          "activities": self.sequence(node),
+          "traces": traces
+        } for node, traces in variants.most_common(self.top_variants)]
+      }
+    }
+
 def xesformat(ts):
   # The XES timestamp format is very nearly compatible with
   # datetime.isoformat(), except that it requires milliseconds instead of any
@@ -166,60 +499,67 @@ def xesformat(ts):
   else:
     return base + "Z"
 
-def string_element(key, v):
-  return etree.Element(
-      "string",
-      key=key,
-      value=v if v else "")
-
-def date_element(key, v):
-  return etree.Element(
-      "date",
-      key=key,
-      value=xesformat(dateutil.parser.parse(v)))
-
-def int_element(key, v):
-  return etree.Element(
-      "int",
-      key=key,
-      value=str(int(v)))
-
-def float_element(key, v):
-  return etree.Element(
-      "float",
-      key=key,
-      value=str(float(v)))
-
-def boolean_element(key, v):
+# Attributes are represented as (tag, key, value) tuples until the moment they
+# are serialised, so that the output backends don't need to agree on anything
+# else
+
+# lxml refuses to create elements from byte strings that aren't ASCII or from
+# strings containing these characters, and the text backend must skip exactly
+# the same attributes that the lxml one does
+invalid_xml_chars = re.compile(
+    u"[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+def xml_compatible(s):
+  if isinstance(s, str):
+    try:
+      s = s.decode("ascii")
+    except UnicodeDecodeError:
+      raise ValueError("""\
+byte string '%s' is not ASCII""" % s)
+  if invalid_xml_chars.search(s):
+    raise ValueError("""\
+string %r is not XML compatible""" % s)
+  return s
+
+def attribute(tag, key, value):
+  return (tag, xml_compatible(key), xml_compatible(value))
+
+def string_attribute(key, v):
+  return attribute("string", key, v if v else "")
+
+def date_attribute(key, v):
+  return attribute("date", key, xesformat(dateutil.parser.parse(v)))
+
+def int_attribute(key, v):
+  return attribute("int", key, str(int(v)))
+
+def float_attribute(key, v):
+  return attribute("float", key, str(float(v)))
+
+def boolean_attribute(key, v):
   value = "false"
   v = v.strip().lower()
   if v == "true" or v == "1" or v == "yes":
     value = "true"
-  return etree.Element(
-      "boolean",
-      key=key,
-      value=value)
+  return attribute("boolean", key, value)
 
-def id_element(key, v):
-  return etree.Element(
-      "id",
-      key=key,
-      value=v)
+def id_attribute(key, v):
+  return attribute("id", key, v)
 
-def uuid_element(key, v):
-  return id_element(key, str(UUID(v)))
+def uuid_attribute(key, v):
+  return id_attribute(key, str(UUID(v)))
 
 elementary_attribute_types = {
-  "string": string_element,
-  "date": date_element,
-  "int": int_element,
-  "float": float_element,
-  "boolean": boolean_element,
-  "id": id_element,
+  "string": string_attribute,
+  "date": date_attribute,
+  "int": int_attribute,
+  "float": float_attribute,
+  "boolean": boolean_attribute,
+  "id": id_attribute,
 
   # Types with a leading underscore are for internal use and do not appear in
   # the help text's list of elementary types
-  "_uuid": uuid_element
+  "_uuid": uuid_attribute
 }
 
 typed_attributes = {
@@ -249,10 +589,16 @@ typed_attributes = {
   # meta-attributes in general are not supported
 }
 
-def make_element(name, value):
+# The types of attributes read from XES documents, which apply only to
+# attributes that typed_attributes doesn't already know about
+xes_types = {}
+
+def make_attribute(name, value):
   element_type = "string"
   if name in typed_attributes:
     element_type = typed_attributes[name]
+  elif name in xes_types:
+    element_type = xes_types[name]
   return elementary_attribute_types[element_type](
       name_to_raw_name(name), value)
 
@@ -270,23 +616,31 @@ def raw_name_to_name(n):
   else:
     return (parts[0], parts[1])
 
-def dict_to_element(d, mappings, preserve=False):
-  el = etree.Element("event")
+# Events are (attributes, raw attributes) pairs; the raw attributes are None
+# unless the input attributes are being preserved
+def dict_to_event(d, mappings, preserve=False):
+  attributes = []
   for (name, values) in mappings.items():
     for value in values:
       try:
         actual = value % d
-        el.append(make_element(name, actual))
+        attributes.append(make_attribute(name, actual))
         break
       except KeyError:
         pass
       except ValueError:
         pass
+  raw = None
   if preserve:
-    el.append(etree.Comment(" Raw event attributes follow: "))
-    for name, value in d.items():
-      el.append(string_element(name, value))
-  return el
+    raw = [string_attribute(name, value) for name, value in d.items()]
+  return (attributes, raw)
+
+def event_value(event, key):
+  attributes, raw = event
+  for _, k, v in attributes + (raw or []):
+    if k == key:
+      return v
+  return None
 
 extensions = {
   "concept": ("Concept", "http://www.xes-standard.org/concept.xesext"),
@@ -298,12 +652,12 @@ extensions = {
   "cost": ("Cost", "http://www.xes-standard.org/cost.xesext")
 }
 
-def get_extension_element(prefix):
+def get_extension(prefix):
   assert prefix in extensions, """\
 prefix "%s" does not specify a known XES extension (see the --xes-extension \
 argument)""" % prefix
   name, uri = extensions[prefix]
-  return etree.Element("extension", name=name, prefix=prefix, uri=uri)
+  return (name, prefix, uri)
 
 def file_handle(a, mode='r'):
   if a.endswith(".gz"):
@@ -311,6 +665,249 @@ def file_handle(a, mode='r'):
   else:
     return open(a, mode)
 
+xml_declaration = "<?xml version='1.0' encoding='UTF-8'?>\n"
+xes_footer = "</log>\n"
+
+def attribute_element(a):
+  tag, key, value = a
+  return etree.Element(tag, key=key, value=value)
+
+def event_element(event):
+  attributes, raw = event
+  el = etree.Element("event")
+  el.extend(map(attribute_element, attributes))
+  if raw is not None:
+    el.append(etree.Comment(" Raw event attributes follow: "))
+    el.extend(map(attribute_element, raw))
+  return el
+
+def lxml_header(extensions):
+  return xml_declaration + "<log>\n" + \
+      "".join("  " + etree.tostring(
+          etree.Element("extension", name=name, prefix=prefix, uri=uri),
+          encoding="utf-8") + "\n" for name, prefix, uri in extensions)
+
+def lxml_trace(attributes, events):
+  trace_el = etree.Element("trace")
+  trace_el.extend(map(attribute_element, attributes))
+  trace_el.extend(map(event_element, events))
+  # Traces are serialised one at a time, but they should look exactly as they
+  # would if lxml had pretty-printed them as part of the whole log
+  text = etree.tostring(trace_el, pretty_print=True, encoding="utf-8")
+  return "".join("  " + l for l in text.splitlines(True))
+
+# The text backend produces the same bytes as the lxml one, but it builds
+# each trace as a single string from these templates without creating any
+# elements at all
+xml_escapes = {
+  "\"": "&quot;",
+  "\n": "&#10;",
+  "\r": "&#13;",
+  "\t": "&#9;"
+}
+
+xml_special_chars = re.compile(u"[&<>\"\n\r\t]")
+
+def xml_escape(s):
+  # Almost nothing actually needs escaping, and searching is much cheaper
+  # than replacing
+  if not xml_special_chars.search(s):
+    return s
+  return escape(s, xml_escapes)
+
+def _attribute_templates(indent):
+  return {tag: u"%s<%s key=\"%%s\" value=\"%%s\"/>\n" % (indent, tag) \
+      for tag in ["string", "date", "int", "float", "boolean", "id"]}
+
+trace_attribute_templates = _attribute_templates(" " * 4)
+event_attribute_templates = _attribute_templates(" " * 6)
+raw_attributes_comment = u"      <!-- Raw event attributes follow: -->\n"
+extension_template = \
+    u"  <extension name=\"%s\" prefix=\"%s\" uri=\"%s\"/>\n"
+
+def text_header(extensions):
+  return xml_declaration + "<log>\n" + "".join(
+      (extension_template % tuple(map(xml_escape, e))).encode("utf-8") \
+          for e in extensions)
+
+def text_trace(attributes, events):
+  parts = []
+  for tag, key, value in attributes:
+    parts.append(trace_attribute_templates[tag] % \
+        (xml_escape(key), xml_escape(value)))
+  for ev_attributes, raw in events:
+    if not ev_attributes and raw is None:
+      parts.append(u"    <event/>\n")
+      continue
+    parts.append(u"    <event>\n")
+    for tag, key, value in ev_attributes:
+      parts.append(event_attribute_templates[tag] % \
+          (xml_escape(key), xml_escape(value)))
+    if raw is not None:
+      parts.append(raw_attributes_comment)
+      for tag, key, value in raw:
+        parts.append(event_attribute_templates[tag] % \
+            (xml_escape(key), xml_escape(value)))
+    parts.append(u"    </event>\n")
+  if not parts:
+    return "  <trace/>\n"
+  return (u"  <trace>\n" + u"".join(parts) + u"  </trace>\n").encode("utf-8")
+
+serialisers = {
+  "text": (text_header, text_trace),
+  "lxml": (lxml_header, lxml_trace)
+}
+
+class XESWriter(threading.Thread):
+  # Each output document has its own writer thread, so that several can be
+  # written (and compressed) at the same time. If no traces are ever written,
+  # empty_document (if given) is written instead of the header and footer,
+  # just as lxml would collapse an empty <log> element
+  def __init__(self, f, header, path=None, empty_document=None):
+    super(XESWriter, self).__init__()
+    self.daemon = True
+    self.f = f
+    self.path = path
+    self.header = header
+    self.empty_document = empty_document
+    self.queue = Queue.Queue(maxsize=256)
+    self.traces = 0
+    self.events = 0
+    # The size of the document so far, counting the footer that's still to
+    # come
+    self.bytes = len(header) + len(xes_footer)
+    self.failure = None
+    self.start()
+
+  def run(self):
+    try:
+      while True:
+        chunk = self.queue.get()
+        if chunk is None:
+          break
+        self.f.write(chunk)
+      if self.f is not sys.stdout:
+        self.f.close()
+      else:
+        self.f.flush()
+    except Exception as e:
+      self.failure = e
+      # Keep draining the queue so that the main thread doesn't block forever
+      while self.queue.get() is not None:
+        pass
+
+  def write_trace(self, key, text, events):
+    if not self.traces:
+      self.queue.put(self.header)
+    self.traces += 1
+    self.events += events
+    self.bytes += len(text)
+    self.queue.put(text)
+
+  def finish(self):
+    if self.traces:
+      self.queue.put(xes_footer)
+    elif self.empty_document:
+      self.queue.put(self.empty_document)
+    else:
+      self.queue.put(self.header + xes_footer)
+    self.queue.put(None)
+
+  def close(self):
+    self.finish()
+    self.join()
+    if self.failure:
+      raise self.failure
+    return [self]
+
+class ShardedXESWriter(object):
+  # Distributes traces across several self-contained XES documents, either by
+  # a hash of the trace key (when shards is set) or by starting a new document
+  # whenever the current one reaches max_traces traces or max_bytes bytes. In
+  # the latter case, a document is finished as soon as the next one is
+  # started, and at most two are ever open at once: the current one and the
+  # one before it, which may still be being written out
+  def __init__(self, pattern, header, empty_document=None,
+      shards=None, max_traces=None, max_bytes=None):
+    self.pattern = pattern
+    self.header = header
+    self.empty_document = empty_document
+    self.shards = shards
+    self.max_traces = max_traces
+    self.max_bytes = max_bytes
+    self.writers = []
+    if shards:
+      for i in xrange(shards):
+        self._open()
+
+  def _open(self):
+    path = self.pattern % len(self.writers)
+    self.writers.append(XESWriter(file_handle(path, "w"), self.header,
+        path=path, empty_document=self.empty_document))
+    return self.writers[-1]
+
+  def write_trace(self, key, text, events):
+    if self.shards:
+      if isinstance(key, unicode):
+        key = key.encode("utf-8")
+      writer = self.writers[(zlib.crc32(key) & 0xffffffff) % self.shards]
+    elif not self.writers:
+      writer = self._open()
+    else:
+      writer = self.writers[-1]
+      if (self.max_traces and writer.traces >= self.max_traces) or \
+          (self.max_bytes and writer.traces and
+              writer.bytes + len(text) > self.max_bytes):
+        if len(self.writers) > 1:
+          self.writers[-2].join()
+        writer.finish()
+        writer = self._open()
+    writer.write_trace(key, text, events)
+
+  def close(self):
+    if not self.writers:
+      self._open()
+    if self.shards:
+      for writer in self.writers:
+        writer.finish()
+    else:
+      self.writers[-1].finish()
+    for writer in self.writers:
+      writer.join()
+    for writer in self.writers:
+      if writer.failure:
+        raise writer.failure
+    return self.writers
+
+# Shard file name patterns must contain precisely one integer conversion
+# specifier (and any number of escaped percent signs)
+shard_specifier = re.compile(r"%[-0 +#]*[0-9]*d")
+
+def valid_shard_pattern(pattern):
+  rest = pattern.replace("%%", "")
+  if len(shard_specifier.findall(rest)) != 1 or \
+      "%" in shard_specifier.sub("", rest):
+    return False
+  try:
+    pattern % 0
+  except (TypeError, ValueError):
+    return False
+  return True
+
+def writable_directory(path):
+  return os.access(os.path.dirname(path) or ".", os.W_OK)
+
+def shard_manifest(writers):
+  return {
+    "traces": sum(w.traces for w in writers),
+    "events": sum(w.events for w in writers),
+    "shards": [{
+      "file": w.path,
+      "traces": w.traces,
+      "events": w.events
+    } for w in writers]
+  }
+
 class ExtendAction(argparse.Action):
   def __init__(self, option_strings, dest, nargs=None,
       default=None, type=None, help=None, metavar=None):
@@ -347,6 +944,22 @@ in the process.""")
       help='print all the loaded events and exit immediately',
       action='store_true',
       dest='dump_events')
+  parser.add_argument(
+      '--stats',
+      help='write summary statistics about the traces (event counts, ' +
+           'time spans, activity frequencies and the most common variants ' +
+           'of the concept:name sequence, in input order) to the output ' +
+           'file as JSON instead of generating a XES document',
+      action='store_true',
+      dest='stats')
+  parser.add_argument(
+      '--stats-variants',
+      metavar='COUNT',
+      help='report the %(metavar)s most common variants in the ' +
+           'statistics (default: %(default)s)',
+      type=int,
+      default=10,
+      dest='stats_variants')
 
   io_group = parser.add_argument_group('input and output selection', """\
 These arguments specify the types and locations of input files and the location
@@ -372,13 +985,29 @@ or compression.""")
       nargs='*',
       type=lambda s: file_handle(s, "r"),
       default=None)
+  io_group.add_argument(
+      '--xes',
+      dest='in_xes',
+      metavar='INFILE',
+      help='load each %(metavar)s, or standard input if none were given, as ' +
+           'a XES document; event attributes are named after their XES ' +
+           'keys, the enclosing trace\'s attributes are prefixed with ' +
+           '\'trace.\', and \'trace#\' identifies the enclosing trace ' +
+           'as the index of %(metavar)s (or \'-\' for standard input), a ' +
+           'dot, and the index of the trace; attributes mapped to their ' +
+           'original keys keep their original types',
+      action=ExtendAction,
+      nargs='*',
+      type=lambda s: file_handle(s, "r"),
+      default=None)
   io_group.add_argument(
       '-o', '--output',
       dest='outfile',
       metavar='OUTFILE',
-      help='the output file (default: standard output)',
-      type=lambda s: file_handle(s, "w"),
-      default=sys.stdout)
+      help='the output file (default: standard output); when the output is ' +
+           'sharded, a pattern containing a \'%%d\' format specifier that ' +
+           'will be replaced with each shard\'s index',
+      default=None)
 
   xml_group = parser.add_argument_group('XML input arguments', """\
 These arguments specify how to select event elements from XML input files.
@@ -443,6 +1072,56 @@ may not contain quoted characters.""")
       help='rename event attributes to include the format and index of ' +
            'the input file they came from',
       action='store_false')
+  ppr_group.add_argument(
+      '--dedupe',
+      dest='dedupe',
+      help='drop events whose attributes exactly match those of an ' +
+           'earlier event (useful when input files overlap); the trace# ' +
+           'attribute of events read from XES logs is ignored',
+      action='store_true')
+  ppr_group.add_argument(
+      '--dedupe-key',
+      dest='dedupe_keys',
+      metavar='ATTR',
+      help='compare only the event attribute %(metavar)s, and any others ' +
+           'named by this option, when looking for duplicate events; ' +
+           'events with none of these attributes are never treated as ' +
+           'duplicates (implies --dedupe)',
+      action='append',
+      default=[])
+  dedupe_store_group = ppr_group.add_mutually_exclusive_group(required=False)
+  dedupe_store_group.add_argument(
+      '--dedupe-bloom',
+      dest='dedupe_bloom',
+      metavar='COUNT',
+      help='remember events seen so far in a fixed-size Bloom filter sized ' +
+           'for %(metavar)s events rather than in memory; some unique ' +
+           'events may be dropped (see --dedupe-error-rate)',
+      type=int,
+      default=None)
+  dedupe_store_group.add_argument(
+      '--dedupe-store',
+      dest='dedupe_store',
+      metavar='FILE',
+      help='remember events seen so far in the on-disk SQLite database ' +
+           '%(metavar)s rather than in memory; any existing file will be ' +
+           'replaced, and the database is deleted afterwards unless ' +
+           '--dedupe-keep-store is given',
+      default=None)
+  ppr_group.add_argument(
+      '--dedupe-keep-store',
+      dest='dedupe_keep_store',
+      help='don\'t delete the --dedupe-store database when finished',
+      action='store_true')
+  ppr_group.add_argument(
+      '--dedupe-error-rate',
+      dest='dedupe_error_rate',
+      metavar='RATE',
+      help='the acceptable false positive rate for --dedupe-bloom; each ' +
+           'halving of %(metavar)s makes every event a little slower to ' +
+           'check (default: %(default)g)',
+      type=float,
+      default=0.001)
   ppr_group.add_argument(
       '--empty-value',
       dest='empty_tokens',
@@ -542,6 +1221,16 @@ attributes.""")
 
   output_group = parser.add_argument_group('output arguments', """\
 These arguments control the generation of the final XES document.""")
+  output_group.add_argument(
+      '--serialiser',
+      metavar='BACKEND',
+      dest='serialiser',
+      choices=sorted(serialisers.keys()),
+      default='text',
+      help='generate the XES document with %(metavar)s: \'text\' writes ' +
+           'it directly from templates, while \'lxml\' builds and ' +
+           'serialises a document tree (slower, but useful for checking ' +
+           'the output of the other) (default: %(default)s)')
   output_group.add_argument(
       '--max-traces',
       metavar='COUNT',
@@ -567,6 +1256,66 @@ These arguments control the generation of the final XES document.""")
       help='split a trace up into several traces whenever there\'s a gap of ' +
            '%(metavar)s days between events (implies --order-by ' +
            'time:timestamp)')
+  output_group.add_argument(
+      '--close-after',
+      metavar='SECONDS',
+      action='store',
+      type=float,
+      dest='close_after',
+      default=None,
+      help='treat the input as being ordered by time:timestamp, and write ' +
+           'out each trace as soon as %(metavar)s seconds of event time ' +
+           'have passed without any new events being added to it; events ' +
+           'that arrive for a trace after it has been written out will ' +
+           'start a new trace')
+  output_group.add_argument(
+      '--reopen-window',
+      metavar='MULTIPLE',
+      action='store',
+      type=float,
+      dest='reopen_window',
+      default=10,
+      help='with --close-after, remember which traces have been written ' +
+           'out for %(metavar)s times the --close-after period, so that ' +
+           'late events can be reported as reopening a trace (default: ' +
+           '%(default)s)')
+
+  shard_group = parser.add_argument_group('output sharding arguments', """\
+These arguments split the output into several self-contained XES documents,
+which are written concurrently. At most one sharding policy may be
+specified.""")
+  shard_policy_group = shard_group.add_mutually_exclusive_group(required=False)
+  shard_policy_group.add_argument(
+      '--shards',
+      metavar='COUNT',
+      type=int,
+      dest='shards',
+      default=None,
+      help='distribute traces across %(metavar)s documents by a hash of ' +
+           'their trace attributes')
+  shard_policy_group.add_argument(
+      '--shard-max-traces',
+      metavar='COUNT',
+      type=int,
+      dest='shard_max_traces',
+      default=None,
+      help='start a new document after every %(metavar)s traces')
+  shard_policy_group.add_argument(
+      '--shard-max-bytes',
+      metavar='SIZE',
+      type=int,
+      dest='shard_max_bytes',
+      default=None,
+      help='start a new document whenever adding a trace would take the ' +
+           'current one over %(metavar)s bytes (before compression, ' +
+           'counting its header and footer)')
+  shard_group.add_argument(
+      '--shard-manifest',
+      metavar='FILE',
+      dest='shard_manifest',
+      default=None,
+      help='write a JSON manifest listing each document\'s trace and event ' +
+           'counts to %(metavar)s (default: standard output)')
   args = parser.parse_args()
 
   if not args.chatty:
@@ -607,17 +1356,44 @@ cannot change the type of "%s" from %s to \
     else:
       typed_attributes[name] = t
 
-  root_el = etree.Element("log")
-
+  used_extensions = []
   used_prefixes = set()
   for (prefix, _) in \
       list(event_attribute_mappings.keys()) + \
       list(trace_attribute_mappings.keys()):
     if not prefix or prefix in used_prefixes:
       continue
-    root_el.append(get_extension_element(prefix))
+    used_extensions.append(get_extension(prefix))
     used_prefixes.add(prefix)
 
+  sharded = bool(
+      args.shards or args.shard_max_traces or args.shard_max_bytes)
+  if sharded:
+    if args.stats:
+      error("--stats cannot be combined with sharded output", usage=True)
+    if not args.outfile:
+      error("sharded output requires an output file pattern", usage=True)
+    if not valid_shard_pattern(args.outfile):
+      error("the output file pattern must contain precisely one '%d' " +
+          "format specifier", usage=True)
+    for policy in [args.shards, args.shard_max_traces, args.shard_max_bytes]:
+      if policy is not None and policy < 1:
+        error("sharding limits must be positive", usage=True)
+    for path in [args.outfile % 0, args.shard_manifest]:
+      if path and not writable_directory(path):
+        error("cannot write to '%s'" % path)
+  elif args.shard_manifest:
+    warn("a shard manifest was requested, but the output is not sharded")
+
+  # Like the input files, an unsharded output file is opened straight away,
+  # so that problems with it show up before any input has been read
+  outfile = sys.stdout
+  if not sharded and args.outfile:
+    try:
+      outfile = file_handle(args.outfile, "w")
+    except IOError as e:
+      error("cannot write to '%s': %s" % (args.outfile, e.strerror))
+
   stdin_used = False
   event_iterators = []
   if args.in_xml != None:
@@ -655,65 +1431,61 @@ cannot change the type of "%s" from %s to \
       stdin_used = True
       event_iterators.append(("csv-.", _csv_handler(sys.stdin)))
 
+  if args.in_xes != None:
+    if args.in_xes:
+      for idx, inf in enumerate(args.in_xes):
+        event_iterators.append(("xes%d." % idx, xes_handler(inf, idx, xes_types)))
+    elif stdin_used:
+      error("cannot load standard input as more than one type of document",
+          usage=True)
+    else:
+      stdin_used = True
+      event_iterators.append(("xes-.", xes_handler(sys.stdin, "-", xes_types)))
+
   if not event_iterators:
     error("no input files were specified", usage=True)
 
+  fingerprints = None
+  if args.dedupe or args.dedupe_keys or args.dedupe_bloom or \
+      args.dedupe_store:
+    if args.dedupe_bloom:
+      fingerprints = BloomFingerprintSet(
+          args.dedupe_bloom, args.dedupe_error_rate)
+    elif args.dedupe_store:
+      fingerprints = DiskFingerprintSet(
+          args.dedupe_store, keep=args.dedupe_keep_store)
+    else:
+      fingerprints = FingerprintSet()
+  dedupe_keys = sorted(set(args.dedupe_keys)) if args.dedupe_keys else None
+
   trace_names = [""]
   for name, values in trace_attribute_mappings.items():
     if name == ("concept", "name"):
       for value in values:
         trace_names.insert(0, value)
 
-  traces = {}
-  traces_in_order = []
-  count = 0
-  for prefix, it in event_iterators:
-    for e in it:
-      if attributes_to_pseudonymise:
-        for attr_name, attr_value in e.items():
-          if attr_name in attributes_to_pseudonymise:
-            e[attr_name] = pseudonymise(
-                attributes_to_pseudonymise[attr_name], attr_value)
-      if args.empty_tokens:
-        e = {a: b for a, b in e.items() if not b in args.empty_tokens}
-      if not args.unify_attributes:
-        e = {prefix + a: b for a, b in e.items()}
-      if not args.dump_events:
-        for t in trace_names:
-          try:
-            possible_name = t % e
-            if not possible_name in traces:
-              traces[possible_name] = []
-              traces_in_order.append(possible_name)
-            traces[possible_name].append(e)
-            count += 1
-            if count % 1000 == 0:
-              progress("Loading events: %d..." % count)
-            break
-          except KeyError:
-            pass
-      else:
-        for attr_name, attr_value in e.items():
-          print("%s: %s" % (attr_name, attr_value))
-        print("--")
-  if args.dump_events:
-    sys.exit(0)
-  total_traces = len(traces)
-  progress("Loaded events: %d, spread across %d traces.\n" % \
-      (count, total_traces))
-
-  if args.max_traces:
-    progress("Pruning to at most %d traces.\n" % args.max_traces)
-    traces = {ti: traces[ti] for ti in traces_in_order[:args.max_traces]}
-    total_traces = len(traces)
+  make_header, make_trace = serialisers[args.serialiser]
+
+  def open_output():
+    header = make_header(used_extensions)
+    empty_document = None
+    if not used_extensions:
+      empty_document = xml_declaration + "<log/>\n"
+    if sharded:
+      return ShardedXESWriter(args.outfile, header,
+          empty_document=empty_document,
+          shards=args.shards,
+          max_traces=args.shard_max_traces,
+          max_bytes=args.shard_max_bytes)
+    else:
+      return XESWriter(outfile, header,
+          path=args.outfile, empty_document=empty_document)
 
-  count = 0
-  for trace in traces:
+  def write_trace(output, trace, trace_events):
     trace_attributes = {}
-    elements = []
-    for event in traces[trace]:
-      event_el = dict_to_element(
-          event, event_attribute_mappings, args.preserve)
+    events = []
+    for event in trace_events:
+      ev = dict_to_event(event, event_attribute_mappings, args.preserve)
       for name, values in trace_attribute_mappings.items():
         for value in values:
           try:
@@ -727,58 +1499,227 @@ trace '%s': not all events have the same value for trace attribute '%s'""" % \
             break
           except KeyError:
             pass
-      elements.append(event_el)
+      events.append(ev)
 
-    subtraces = [elements]
+    subtraces = [events]
     if args.order_by:
       assert not args.split_after, """\
 the --split-after option cannot be used with --order-by"""
-      def _gtsv(el):
-        for i in el.iterdescendants():
-          if i.get("key") == args.order_by:
-            return i.get("value")
-        return None
-      elements.sort(key=_gtsv)
+      events.sort(key=lambda ev: event_value(ev, args.order_by))
     elif args.split_after:
-      def _gtsv(el):
-        for i in el.iterdescendants():
-          if i.get("key") == "time:timestamp":
-            return i.get("value")
-      elements.sort(key=_gtsv)
+      def _gtsv(ev):
+        return event_value(ev, "time:timestamp")
+      events.sort(key=_gtsv)
       subtraces = [[]]
       last_ts = None
-      for ev_el in elements:
-        this_ts = _gtsv(ev_el)
+      for ev in events:
+        this_ts = _gtsv(ev)
         if this_ts:
           this_ts = dateutil.parser.parse(this_ts)
         if this_ts and last_ts and \
             (this_ts - last_ts).days >= args.split_after:
           subtraces.append([])
         last_ts = this_ts
-        subtraces[-1].append(ev_el)
+        subtraces[-1].append(ev)
 
     multiple_subtraces = len(subtraces) != 1
     for i, st in enumerate(subtraces):
-      trace_el = etree.Element("trace")
+      attributes = []
       for name, actual in trace_attributes.items():
         try:
-          attrib_el = make_element(name, actual)
-          if multiple_subtraces and attrib_el.get("key") == "concept:name":
-            attrib_el.set("value", attrib_el.get("value") + "/%d" % (i + 1))
-          trace_el.append(attrib_el)
+          tag, key, value = make_attribute(name, actual)
+          if multiple_subtraces and key == "concept:name":
+            value += "/%d" % (i + 1)
+          attributes.append((tag, key, value))
         except ValueError:
           pass
-      trace_el.extend(st)
-      root_el.append(trace_el)
+      output.write_trace(trace, make_trace(attributes, st), len(st))
+
+  # When traces are closed after a period of inactivity, they're written out
+  # while the input is still being read. active maps the keys of open traces
+  # to the event time at which they were last touched, least recent first,
+  # and closed maps (digests of) the keys of traces already written out to
+  # the event time at which they were closed, forgetting them once they're
+  # older than --reopen-window times --close-after
+  output = None
+  streaming = args.close_after is not None and \
+      not (args.dump_events or args.stats)
+  if streaming:
+    timestamp_values = event_attribute_mappings.get(("time", "timestamp"), [])
+    if not timestamp_values:
+      error("--close-after requires a mapping for time:timestamp", usage=True)
+    if args.reopen_window < 0:
+      error("--reopen-window must not be negative", usage=True)
+    output = open_output()
+  elif args.close_after is not None:
+    warn("--close-after has no effect with --dump-events or --stats")
+  if args.stats and args.max_traces:
+    warn("--max-traces has no effect with --stats")
+  active = OrderedDict()
+  closed = OrderedDict()
+  clock = None
+  opened = 0
+  written = 0
+  reopened = 0
+
+  def close_trace(trace):
+    del active[trace]
+    write_trace(output, trace, traces.pop(trace))
+    digest = hashlib.sha1(trace.encode("utf-8") \
+        if isinstance(trace, unicode) else trace).digest()[:8]
+    closed.pop(digest, None)
+    closed[digest] = clock
+    while closed and clock is not None:
+      oldest, closed_at = next(closed.iteritems())
+      if clock - closed_at <= args.reopen_window * args.close_after:
+        break
+      del closed[oldest]
 
-    count += 1
-    if count % 1000 == 0:
-      progress("Processing traces: %d/%d (%g%%)...        \b\b\b\b\b\b\b\b" % \
-          (count, total_traces, (float(count) / total_traces) * 100))
+  stats = None
+  if args.stats:
+    stats = LogStatistics(
+        event_attribute_mappings.get(("concept", "name"), []),
+        event_attribute_mappings.get(("time", "timestamp"), []),
+        top_variants=args.stats_variants)
+
+  traces = {}
+  traces_in_order = []
+  count = 0
+  duplicates = 0
+  for prefix, it in event_iterators:
+    for e in it:
+      if attributes_to_pseudonymise:
+        for attr_name, attr_value in e.items():
+          if attr_name in attributes_to_pseudonymise:
+            e[attr_name] = pseudonymise(
+                attributes_to_pseudonymise[attr_name], attr_value)
+      if args.empty_tokens:
+        e = {a: b for a, b in e.items() if not b in args.empty_tokens}
+      # Events are fingerprinted before --distinguish-attributes renames
+      # anything, as otherwise overlapping input files could never share an
+      # event
+      if fingerprints:
+        fp = event_fingerprint(e, dedupe_keys)
+        if fp is not None and not fingerprints.add(fp):
+          duplicates += 1
+          continue
+      if not args.unify_attributes:
+        e = {prefix + a: b for a, b in e.items()}
+      if not args.dump_events:
+        for t in trace_names:
+          try:
+            possible_name = t % e
+            if stats:
+              stats.add(possible_name, e)
+            elif streaming:
+              ts = first_mapped_value(e, timestamp_values)
+              if ts is not None:
+                try:
+                  ts = epoch_seconds(parse_timestamp(ts))
+                  if clock is None:
+                    # Traces that were opened before the clock started are
+                    # treated as having been touched when it did
+                    for trace in active:
+                      active[trace] = ts
+                  if clock is None or ts > clock:
+                    clock = ts
+                except (ValueError, OverflowError):
+                  pass
+              if not possible_name in traces:
+                if args.max_traces and opened >= args.max_traces:
+                  break
+                digest = hashlib.sha1(possible_name.encode("utf-8") \
+                    if isinstance(possible_name, unicode) \
+                    else possible_name).digest()[:8]
+                if digest in closed:
+                  reopened += 1
+                  warn("trace '%s' received an event after it was closed; " \
+                      "starting a new trace" % possible_name)
+                traces[possible_name] = []
+                opened += 1
+              traces[possible_name].append(e)
+              active.pop(possible_name, None)
+              active[possible_name] = clock
+              while active and clock is not None:
+                oldest, last_seen = next(active.iteritems())
+                if clock - last_seen <= args.close_after:
+                  break
+                close_trace(oldest)
+                written += 1
+            else:
+              if not possible_name in traces:
+                traces[possible_name] = []
+                traces_in_order.append(possible_name)
+              traces[possible_name].append(e)
+            count += 1
+            if count % 1000 == 0:
+              progress("Loading events: %d..." % count)
+            break
+          except KeyError:
+            pass
+      else:
+        for attr_name, attr_value in e.items():
+          print("%s: %s" % (attr_name, attr_value))
+        print("--")
+  if fingerprints:
+    fingerprints.close()
+  if args.dump_events:
+    sys.exit(0)
+  if stats:
+    if fingerprints:
+      progress("Removed duplicate events: %d.\n" % duplicates)
+    progress("Summarising %d events... " % count)
+    summary = stats.summary()
+    if fingerprints:
+      summary["duplicates"] = duplicates
+    summary = json.dumps(summary, indent=2, sort_keys=True)
+    outfile.write(summary + "\n")
+    if outfile is not sys.stdout:
+      outfile.close()
+    progress("done.\n")
+    sys.exit(0)
+
+  if streaming:
+    progress("Loaded events: %d, spread across %d traces.\n" % \
+        (count, opened))
+    if fingerprints:
+      progress("Removed duplicate events: %d.\n" % duplicates)
+    if reopened:
+      progress("Traces reopened after being closed: %d.\n" % reopened)
+    progress("Closed traces before the end of the input: %d/%d.\n" % \
+        (written, opened))
+    count = total_traces = opened
+    for trace in list(active.keys()):
+      close_trace(trace)
+  else:
+    total_traces = len(traces)
+    progress("Loaded events: %d, spread across %d traces.\n" % \
+        (count, total_traces))
+    if fingerprints:
+      progress("Removed duplicate events: %d.\n" % duplicates)
+
+    if args.max_traces:
+      progress("Pruning to at most %d traces.\n" % args.max_traces)
+      traces = {ti: traces[ti] for ti in traces_in_order[:args.max_traces]}
+      total_traces = len(traces)
+
+    output = open_output()
+    count = 0
+    for trace in traces:
+      write_trace(output, trace, traces[trace])
+      count += 1
+      if count % 1000 == 0:
+        progress("Processing traces: %d/%d (%g%%)...        \b\b\b\b\b\b\b\b" % \
+            (count, total_traces, (float(count) / total_traces) * 100))
   progress("Processed traces: %d/%d (100%%).          \n" % (count, total_traces))
   progress("Writing XML document... ")
-  etree.ElementTree(root_el).write(args.outfile,
-      pretty_print=True,
-      encoding="utf-8",
-      xml_declaration=True)
+  writers = output.close()
   progress("Writing XML document... done.\n")
+  if sharded:
+    progress("Wrote %d shards.\n" % len(writers))
+    manifest = json.dumps(shard_manifest(writers), indent=2, sort_keys=True)
+    if args.shard_manifest:
+      with file_handle(args.shard_manifest, "w") as f:
+        f.write(manifest + "\n")
+    else:
+      print(manifest)